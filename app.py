@@ -4,6 +4,7 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.responses import HTMLResponse, StreamingResponse
 from pydantic import BaseModel
 from vllm import SamplingParams
+from vllm.sampling_params import StructuredOutputsParams
 from vllm.engine.arg_utils import AsyncEngineArgs
 from vllm.engine.async_llm_engine import AsyncLLMEngine
 from vllm.utils import random_uuid
@@ -13,7 +14,10 @@ import asyncio
 import os
 from io import BytesIO
 import threading
-from typing import List
+import time
+from typing import List, Literal, Optional
+
+from gpu_memory import blocks_per_sequence, fit_max_model_len, kv_cache_bytes
 
 app = FastAPI()
 # Set up logging
@@ -60,11 +64,228 @@ VLLM_GPU_MEMORY_UTILIZATION = _env_float("VLLM_GPU_MEMORY_UTILIZATION", 0.6)
 VLLM_MAX_MODEL_LEN = _env_int("VLLM_MAX_MODEL_LEN", 4096)
 VLLM_MAX_TOKENS = _env_int("VLLM_MAX_TOKENS", 2048)
 VLLM_ENFORCE_EAGER = _env_bool("VLLM_ENFORCE_EAGER", True)
+STRUCTURED_OUTPUT_CACHE_MB = _env_int("STRUCTURED_OUTPUT_CACHE_MB", 256)
+PREDICT_BATCH_MAX_ITEMS = _env_int("PREDICT_BATCH_MAX_ITEMS", 256)
+
+# Speculative decoding. VLLM_SPECULATIVE_METHOD: "" (off) or "ngram" (prompt lookup).
+VLLM_SPECULATIVE_METHOD = os.environ.get("VLLM_SPECULATIVE_METHOD", "").strip().lower()
+VLLM_SPECULATIVE_NUM_TOKENS = _env_int("VLLM_SPECULATIVE_NUM_TOKENS", 4)
+VLLM_NGRAM_PROMPT_LOOKUP_MIN = _env_int("VLLM_NGRAM_PROMPT_LOOKUP_MIN", 2)
+VLLM_NGRAM_PROMPT_LOOKUP_MAX = _env_int("VLLM_NGRAM_PROMPT_LOOKUP_MAX", 4)
+# Transformers prompt-lookup decoding for the image endpoints (0 disables).
+GEMMA_VISION_PROMPT_LOOKUP_TOKENS = _env_int("GEMMA_VISION_PROMPT_LOOKUP_TOKENS", 0)
+
+
+def _speculative_config():
+    """Translate the VLLM_SPECULATIVE_* settings into vLLM's `speculative_config` (None disables)."""
+    method = VLLM_SPECULATIVE_METHOD
+    if method in {"", "off", "none"}:
+        return None
+    if method == "ngram":
+        return {
+            "method": "ngram",
+            "num_speculative_tokens": VLLM_SPECULATIVE_NUM_TOKENS,
+            "prompt_lookup_min": VLLM_NGRAM_PROMPT_LOOKUP_MIN,
+            "prompt_lookup_max": VLLM_NGRAM_PROMPT_LOOKUP_MAX,
+        }
+    if method == "draft":
+        # vLLM 0.13 raises NotImplementedError for standalone draft models in its V1 engine.
+        logger.warning("VLLM_SPECULATIVE_METHOD=draft is not supported by the pinned vLLM; speculative decoding disabled")
+        return None
+    logger.warning(f"Invalid VLLM_SPECULATIVE_METHOD={method!r}; speculative decoding disabled")
+    return None
+
+
+VLLM_SPECULATIVE_CONFIG = _speculative_config()
+
+VLLM_MODEL_PATH = "/app/models/gemma-3-4b-it"
+GEMMA_MODEL_PATH = os.environ.get("GEMMA_MODEL_PATH", VLLM_MODEL_PATH)
+
+# GPU memory planner: size vLLM's KV cache around the (co-resident) Transformers vision model.
+GPU_MEMORY_PLANNER = _env_bool("GPU_MEMORY_PLANNER", True)
+GPU_MEMORY_SAFETY_MARGIN = _env_float("GPU_MEMORY_SAFETY_MARGIN", 0.05)
+VLLM_ACTIVATION_RESERVE_MB = _env_int("VLLM_ACTIVATION_RESERVE_MB", 3072)
+GEMMA_VISION_PRELOAD = _env_bool("GEMMA_VISION_PRELOAD", False)
+GEMMA_VISION_MAX_CONTEXT = _env_int("GEMMA_VISION_MAX_CONTEXT", 4096)
+GEMMA_VISION_ACTIVATION_RESERVE_MB = _env_int("GEMMA_VISION_ACTIVATION_RESERVE_MB", 1024)
+# Concurrent vision `model.generate` calls; the planner reserves memory for this many.
+GEMMA_VISION_MAX_CONCURRENCY = max(_env_int("GEMMA_VISION_MAX_CONCURRENCY", 1), 1)
+# Smallest context the planner may shrink VLLM_MAX_MODEL_LEN to before refusing to start.
+VLLM_MIN_MODEL_LEN = _env_int("VLLM_MIN_MODEL_LEN", 1024)
+
+_MIB = 1024 * 1024
 
 _vision_lock = asyncio.Lock()
 _vision_processor = None
 _vision_model = None
 _vision_device = None
+_vision_generate_slots = threading.BoundedSemaphore(GEMMA_VISION_MAX_CONCURRENCY)
+
+# xgrammar compiler for the Transformers (vision) path; it caches compiled grammars itself.
+_grammar_lock = threading.Lock()
+_grammar_compiler = None
+
+# Per-endpoint generation counters, reported by /speculative.
+_generation_stats = {}
+
+
+def _load_gemma_vision():
+    """Load multimodal gemma-3-4b-it (blocking) and publish it to the module globals."""
+    global _vision_processor, _vision_model, _vision_device
+
+    import torch
+    from transformers import AutoProcessor, Gemma3ForConditionalGeneration
+
+    model_path = GEMMA_MODEL_PATH
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    processor = AutoProcessor.from_pretrained(model_path)
+
+    if device == "cuda":
+        model = Gemma3ForConditionalGeneration.from_pretrained(
+            model_path,
+            device_map="auto",
+            torch_dtype=torch.bfloat16,
+        ).eval()
+    else:
+        model = Gemma3ForConditionalGeneration.from_pretrained(
+            model_path,
+            device_map="cpu",
+        ).eval()
+
+    _vision_processor = processor
+    _vision_model = model
+    _vision_device = device
+    logger.info(f"Gemma vision model ready on {device}: {model_path}")
+
+    return _vision_processor, _vision_model, _vision_device
+
+
+def _vision_generate(model, **kwargs):
+    """Run the vision model's `generate` within the GEMMA_VISION_MAX_CONCURRENCY limit (blocking)."""
+    import torch
+
+    with _vision_generate_slots:
+        with torch.inference_mode():
+            return model.generate(**kwargs)
+
+
+def _checkpoint_bytes(model_path: str) -> int:
+    """Size of the model's safetensors weights on disk (== bf16 weight footprint on GPU)."""
+    total = 0
+    for name in os.listdir(model_path):
+        if name.endswith(".safetensors"):
+            total += os.path.getsize(os.path.join(model_path, name))
+    return total
+
+
+def _plan_gpu_memory() -> dict:
+    """Split GPU memory between the vision model and vLLM before the engine starts.
+
+    Weights are measured from the checkpoint, the vision model is measured when
+    GEMMA_VISION_PRELOAD loads it up front (otherwise it is reserved as weights
+    plus generation KV/activations), and vLLM gets everything else minus a
+    safety margin. An explicit VLLM_GPU_MEMORY_UTILIZATION is treated as a cap.
+    If the estimated KV cache cannot hold one VLLM_MAX_MODEL_LEN sequence, the
+    context is shrunk (see `gpu_memory.fit_max_model_len`), and startup is
+    refused when even min(VLLM_MIN_MODEL_LEN, VLLM_MAX_MODEL_LEN) does not fit.
+    vLLM profiles and sizes its own KV cache from the resulting
+    utilization; the real capacity is read back after init.
+    """
+    plan = {
+        "planner": "static",
+        "gpu_memory_utilization": VLLM_GPU_MEMORY_UTILIZATION,
+        "max_model_len": VLLM_MAX_MODEL_LEN,
+    }
+    if not GPU_MEMORY_PLANNER:
+        return plan
+
+    import torch
+
+    if not torch.cuda.is_available():
+        plan["reason"] = "CUDA not available"
+        return plan
+
+    # Sizes are read from local checkpoints; hub model ids fall back to the static plan.
+    for model_path in [VLLM_MODEL_PATH] + ([] if GEMMA_VISION_PRELOAD else [GEMMA_MODEL_PATH]):
+        if not os.path.isdir(model_path):
+            logger.warning(f"GPU memory planner needs a local model directory, got {model_path!r}; using static plan")
+            plan["reason"] = f"{model_path} is not a local directory"
+            return plan
+
+    from transformers import AutoConfig
+
+    config = AutoConfig.from_pretrained(VLLM_MODEL_PATH)
+    text_config = config.get_text_config() if hasattr(config, "get_text_config") else config
+
+    # Note: this initializes CUDA in the API process; vLLM then starts its engine core with `spawn`.
+    free_bytes, total_bytes = torch.cuda.mem_get_info()
+    weights_bytes = _checkpoint_bytes(VLLM_MODEL_PATH)
+    vision_runtime_bytes = GEMMA_VISION_MAX_CONCURRENCY * (
+        kv_cache_bytes(text_config, GEMMA_VISION_MAX_CONTEXT) + GEMMA_VISION_ACTIVATION_RESERVE_MB * _MIB
+    )
+
+    if GEMMA_VISION_PRELOAD:
+        _load_gemma_vision()
+        torch.cuda.synchronize()
+        free_after, _ = torch.cuda.mem_get_info()
+        vision_weights_bytes = free_bytes - free_after
+        vision_measured = True
+        free_bytes = free_after
+    else:
+        vision_weights_bytes = _checkpoint_bytes(GEMMA_MODEL_PATH)
+        vision_measured = False
+
+    # Memory already in use (CUDA contexts, other processes, a preloaded vision model) is off limits.
+    in_use_bytes = total_bytes - free_bytes
+    reserved_bytes = vision_runtime_bytes + (0 if vision_measured else vision_weights_bytes)
+    margin_bytes = int(total_bytes * GPU_MEMORY_SAFETY_MARGIN)
+    vllm_bytes = free_bytes - reserved_bytes - margin_bytes
+
+    utilization = vllm_bytes / total_bytes
+    if "VLLM_GPU_MEMORY_UTILIZATION" in os.environ and VLLM_GPU_MEMORY_UTILIZATION < utilization:
+        utilization = VLLM_GPU_MEMORY_UTILIZATION
+        vllm_bytes = int(total_bytes * utilization)
+    elif "VLLM_GPU_MEMORY_UTILIZATION" in os.environ and VLLM_GPU_MEMORY_UTILIZATION > utilization:
+        logger.warning(
+            f"VLLM_GPU_MEMORY_UTILIZATION={VLLM_GPU_MEMORY_UTILIZATION} would overcommit the GPU; "
+            f"lowering to {utilization:.3f}"
+        )
+
+    kv_budget_bytes = vllm_bytes - weights_bytes - VLLM_ACTIVATION_RESERVE_MB * _MIB
+    max_model_len = fit_max_model_len(kv_budget_bytes, text_config, VLLM_MAX_MODEL_LEN, VLLM_MIN_MODEL_LEN)
+    if max_model_len != VLLM_MAX_MODEL_LEN:
+        logger.warning(
+            f"Estimated KV cache cannot hold one {VLLM_MAX_MODEL_LEN}-token sequence; lowering max_model_len to {max_model_len}"
+        )
+    sequence_kv_bytes = kv_cache_bytes(text_config, max_model_len)
+
+    plan.update(
+        {
+            "planner": "measured",
+            "gpu_memory_utilization": round(utilization, 4),
+            "max_model_len": max_model_len,
+            "total_mib": round(total_bytes / _MIB),
+            "in_use_at_startup_mib": round(in_use_bytes / _MIB),
+            "free_before_vllm_mib": round(free_bytes / _MIB),
+            "safety_margin_mib": round(margin_bytes / _MIB),
+            "vllm_mib": round(vllm_bytes / _MIB),
+            "weights_mib": round(weights_bytes / _MIB),
+            "activation_reserve_mib": VLLM_ACTIVATION_RESERVE_MB,
+            # Pre-init estimates; the engine's actual KV capacity is added after startup.
+            "estimated_kv_cache_mib": round(kv_budget_bytes / _MIB),
+            "estimated_kv_mib_per_sequence": round(sequence_kv_bytes / _MIB, 1),
+            "estimated_max_concurrent_sequences": int(kv_budget_bytes // sequence_kv_bytes),
+            "vision": {
+                "preloaded": vision_measured,
+                "weights_mib": round(vision_weights_bytes / _MIB),
+                "max_concurrency": GEMMA_VISION_MAX_CONCURRENCY,
+                "runtime_reserve_mib": round(vision_runtime_bytes / _MIB),
+                "reserved_mib": round(reserved_bytes / _MIB),
+            },
+        }
+    )
+    return plan
 
 # Initialize model immediately on startup
 logger.info("Initializing vLLM with gemma-3-4b-it model...")
@@ -73,16 +294,52 @@ logger.info(f"NVIDIA_VISIBLE_DEVICES: {os.environ.get('NVIDIA_VISIBLE_DEVICES',
 
 # Initialize vLLM with the gemma-3-4b-it model
 try:
+    GPU_MEMORY_PLAN = _plan_gpu_memory()
+    VLLM_GPU_MEMORY_UTILIZATION = GPU_MEMORY_PLAN["gpu_memory_utilization"]
+    VLLM_MAX_MODEL_LEN = GPU_MEMORY_PLAN["max_model_len"]
+    logger.info(f"GPU memory plan: {GPU_MEMORY_PLAN}")
+
     engine_args = AsyncEngineArgs(
-        model="/app/models/gemma-3-4b-it",
+        model=VLLM_MODEL_PATH,
         tensor_parallel_size=1,  # Adjust based on number of GPUs
         gpu_memory_utilization=VLLM_GPU_MEMORY_UTILIZATION,
         max_model_len=VLLM_MAX_MODEL_LEN,
         enforce_eager=VLLM_ENFORCE_EAGER,
         trust_remote_code=True,
+        speculative_config=VLLM_SPECULATIVE_CONFIG,
     )
+    if VLLM_SPECULATIVE_CONFIG:
+        logger.info(f"Speculative decoding enabled: {VLLM_SPECULATIVE_CONFIG}")
     llm = AsyncLLMEngine.from_engine_args(engine_args)
     logger.info("Model engine initialized successfully with vLLM AsyncLLMEngine!")
+
+    # Actual KV capacity as profiled and allocated by the engine. Blocks are shared
+    # across Gemma 3's sliding/full-attention cache groups, so concurrency follows
+    # vLLM's own per-request block count rather than blocks * block_size.
+    cache_config = llm.vllm_config.cache_config
+    if cache_config.num_gpu_blocks:
+        from transformers import AutoConfig
+
+        engine_config = AutoConfig.from_pretrained(VLLM_MODEL_PATH)
+        sequence_blocks = blocks_per_sequence(
+            engine_config.get_text_config() if hasattr(engine_config, "get_text_config") else engine_config,
+            VLLM_MAX_MODEL_LEN,
+            cache_config.block_size,
+            llm.vllm_config.scheduler_config.max_num_batched_tokens,
+        )
+        GPU_MEMORY_PLAN["kv_cache_blocks"] = cache_config.num_gpu_blocks
+        GPU_MEMORY_PLAN["kv_blocks_per_sequence"] = sequence_blocks
+        GPU_MEMORY_PLAN["max_concurrent_sequences"] = round(cache_config.num_gpu_blocks / sequence_blocks, 2)
+
+    if GPU_MEMORY_PLAN["planner"] == "measured":
+        import torch
+
+        # Actual footprint of the engine (weights + activations + KV cache), measured device-wide.
+        free_bytes, _ = torch.cuda.mem_get_info()
+        GPU_MEMORY_PLAN["vllm_measured_mib"] = GPU_MEMORY_PLAN["free_before_vllm_mib"] - round(free_bytes / _MIB)
+        GPU_MEMORY_PLAN["free_after_vllm_mib"] = round(free_bytes / _MIB)
+        if GPU_MEMORY_PLAN["free_after_vllm_mib"] < GPU_MEMORY_PLAN["vision"]["reserved_mib"]:
+            logger.warning(f"Free GPU memory after vLLM init is below the vision reserve: {GPU_MEMORY_PLAN}")
 except Exception as e:
     logger.error(f"Failed to load model: {e}")
     raise
@@ -102,7 +359,6 @@ async def _add_instance_id_header(request, call_next):
 
 async def _get_gemma_vision():
     """Lazy-load multimodal gemma-3-4b-it for image+text -> text generation."""
-    global _vision_processor, _vision_model, _vision_device
     if _vision_processor is not None and _vision_model is not None:
         return _vision_processor, _vision_model, _vision_device
 
@@ -110,32 +366,254 @@ async def _get_gemma_vision():
         if _vision_processor is not None and _vision_model is not None:
             return _vision_processor, _vision_model, _vision_device
 
-        import torch
-        from transformers import AutoProcessor, Gemma3ForConditionalGeneration
+        return _load_gemma_vision()
 
-        model_path = os.environ.get("GEMMA_MODEL_PATH", "/app/models/gemma-3-4b-it")
-        device = "cuda" if torch.cuda.is_available() else "cpu"
 
-        processor = AutoProcessor.from_pretrained(model_path)
+def _parse_structured_output(json_schema=None, regex: Optional[str] = None):
+    """Validate structured-output options and return ("json" | "regex", spec) or None.
 
-        if device == "cuda":
-            model = Gemma3ForConditionalGeneration.from_pretrained(
-                model_path,
-                device_map="auto",
-                torch_dtype=torch.bfloat16,
-            ).eval()
-        else:
-            model = Gemma3ForConditionalGeneration.from_pretrained(
-                model_path,
-                device_map="cpu",
-            ).eval()
+    JSON schemas are canonicalized (sorted keys, compact separators) so equivalent
+    schemas share a cache entry.
+    """
+    if json_schema in (None, "") and regex in (None, ""):
+        return None
+    if json_schema not in (None, "") and regex not in (None, ""):
+        raise HTTPException(status_code=400, detail="Specify only one of json_schema or regex")
 
-        _vision_processor = processor
-        _vision_model = model
-        _vision_device = device
-        logger.info(f"Gemma vision model ready on {device}: {model_path}")
+    if regex not in (None, ""):
+        return "regex", regex
+
+    if isinstance(json_schema, str):
+        try:
+            json_schema = json.loads(json_schema)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"json_schema is not valid JSON: {e}")
+    if not isinstance(json_schema, dict):
+        raise HTTPException(status_code=400, detail="json_schema must be a JSON object")
+
+    return "json", json.dumps(json_schema, sort_keys=True, separators=(",", ":"))
+
+
+def _vllm_structured_outputs(structured_output):
+    """Build vLLM structured-output params (vLLM caches compiled grammars in its backend)."""
+    if structured_output is None:
+        return None
+    kind, spec = structured_output
+    if kind == "json":
+        return StructuredOutputsParams(json=spec)
+    return StructuredOutputsParams(regex=spec)
+
+
+def _get_grammar_compiler(processor, model):
+    """Create the shared xgrammar compiler once (building the tokenizer index is slow)."""
+    global _grammar_compiler
+    with _grammar_lock:
+        if _grammar_compiler is None:
+            import xgrammar as xgr
+
+            text_config = getattr(model.config, "text_config", model.config)
+            tokenizer_info = xgr.TokenizerInfo.from_huggingface(
+                processor.tokenizer,
+                vocab_size=text_config.vocab_size,
+            )
+            _grammar_compiler = xgr.GrammarCompiler(
+                tokenizer_info,
+                cache_enabled=True,
+                cache_limit_bytes=STRUCTURED_OUTPUT_CACHE_MB * 1024 * 1024,
+            )
+        return _grammar_compiler
+
+
+def _get_compiled_grammar(processor, model, structured_output):
+    """Compile (or fetch from cache) an xgrammar grammar for the Transformers vision model.
+
+    The compiler is thread-safe and caches results keyed by the (canonicalized)
+    schema or regex, so repeat requests skip compilation and concurrent
+    requests do not wait on each other's compiles.
+
+    Blocking: building the tokenizer index and compiling a new schema can take
+    seconds, so async callers run this via `asyncio.to_thread`.
+    """
+    if structured_output is None:
+        return None
+
+    kind, spec = structured_output
+    compiler = _get_grammar_compiler(processor, model)
+    try:
+        if kind == "json":
+            return compiler.compile_json_schema(spec)
+        return compiler.compile_regex(spec)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid {kind} constraint: {e}")
+
+
+def _structured_logits_processor(compiled_grammar):
+    """Create a fresh (stateful) logits processor for one `model.generate` call."""
+    if compiled_grammar is None:
+        return None
+
+    import xgrammar as xgr
+    from transformers import LogitsProcessorList
+
+    return LogitsProcessorList([xgr.contrib.hf.LogitsProcessor(compiled_grammar)])
 
-        return _vision_processor, _vision_model, _vision_device
+
+def _format_prompt(prompt: str) -> str:
+    """Wrap a user prompt in the Gemma chat template."""
+    return f"<start_of_turn>user\n{prompt}<end_of_turn>\n<start_of_turn>model\n"
+
+
+def _sampling_params(
+    temperature: float = 0.7,
+    top_p: float = 0.9,
+    max_tokens: int = VLLM_MAX_TOKENS,
+    structured_output=None,
+) -> SamplingParams:
+    """Sampling parameters shared by the vLLM text endpoints."""
+    return SamplingParams(
+        temperature=temperature,
+        top_p=top_p,
+        max_tokens=max_tokens,
+        stop=["<end_of_turn>"],
+        structured_outputs=_vllm_structured_outputs(structured_output),
+    )
+
+
+def _vision_speculative_kwargs(compiled_grammar=None) -> dict:
+    """Extra `model.generate` kwargs enabling prompt-lookup decoding for the vision model.
+
+    Skipped for constrained requests: assisted decoding runs logits processors
+    over draft positions, and the stateful xgrammar processor cannot roll back
+    rejected drafts.
+    """
+    if GEMMA_VISION_PROMPT_LOOKUP_TOKENS > 0 and compiled_grammar is None:
+        return {"prompt_lookup_num_tokens": GEMMA_VISION_PROMPT_LOOKUP_TOKENS}
+    return {}
+
+
+def _record_generation(
+    endpoint: str,
+    completion_tokens: int,
+    start_time: float,
+    first_token_time: Optional[float],
+    end_time: float,
+    decode_steps: Optional[int] = None,
+):
+    """Accumulate per-endpoint latency and throughput counters.
+
+    Decode throughput counts tokens after the first one over the time since the
+    first token, so queueing and prefill do not dilute it. `decode_steps` is
+    only known for the Transformers path (one streamer call per step).
+    """
+    stats = _generation_stats.setdefault(
+        endpoint,
+        {
+            "requests": 0,
+            "completion_tokens": 0,
+            "elapsed_seconds": 0.0,
+            "ttft_requests": 0,
+            "ttft_seconds": 0.0,
+            "decode_tokens": 0,
+            "decode_seconds": 0.0,
+            "stepped_tokens": 0,
+            "decode_steps": 0,
+        },
+    )
+    stats["requests"] += 1
+    stats["completion_tokens"] += completion_tokens
+    stats["elapsed_seconds"] += end_time - start_time
+    if first_token_time is not None:
+        stats["ttft_requests"] += 1
+        stats["ttft_seconds"] += first_token_time - start_time
+        if completion_tokens > 1:
+            stats["decode_tokens"] += completion_tokens - 1
+            stats["decode_seconds"] += end_time - first_token_time
+    if decode_steps:
+        stats["stepped_tokens"] += completion_tokens
+        stats["decode_steps"] += decode_steps
+
+
+class _GenerationTimer:
+    """Duck-typed `generate()` streamer that timestamps tokens for the vision endpoints.
+
+    Optionally forwards to another streamer. Each `put` after the prompt is one
+    decode step; under prompt-lookup decoding it carries the prompt token plus
+    accepted drafts, so tokens / steps is the mean acceptance length.
+    """
+
+    def __init__(self, inner=None):
+        self.inner = inner
+        self.start_time = time.time()
+        self.first_token_time = None
+        self.end_time = None
+        self.tokens = 0
+        self.steps = 0
+        self._prompt_seen = False
+
+    def put(self, value):
+        if self.inner is not None:
+            self.inner.put(value)
+        if not self._prompt_seen:
+            self._prompt_seen = True
+            return
+        if self.first_token_time is None:
+            self.first_token_time = time.time()
+        self.tokens += value.numel()
+        self.steps += 1
+
+    def end(self):
+        if self.inner is not None:
+            self.inner.end()
+        if self.end_time is None:
+            self.end_time = time.time()
+
+    def record(self, endpoint: str):
+        _record_generation(
+            endpoint,
+            self.tokens,
+            self.start_time,
+            self.first_token_time,
+            self.end_time or time.time(),
+            self.steps,
+        )
+
+
+def _engine_spec_decode_counters():
+    """Read vLLM's speculative decoding Prometheus counters (engine-wide, all endpoints)."""
+    if not VLLM_SPECULATIVE_CONFIG:
+        return None
+    try:
+        from prometheus_client import REGISTRY
+    except ImportError:
+        return None
+
+    names = {
+        "vllm:spec_decode_num_drafts_total": "num_drafts",
+        "vllm:spec_decode_num_draft_tokens_total": "num_draft_tokens",
+        "vllm:spec_decode_num_accepted_tokens_total": "num_accepted_tokens",
+    }
+    counters = {key: 0.0 for key in names.values()}
+    found = False
+    for metric in REGISTRY.collect():
+        for sample in metric.samples:
+            key = names.get(sample.name)
+            if key is not None:
+                counters[key] += sample.value
+                found = True
+    if not found:
+        return None
+
+    drafts = counters["num_drafts"]
+    draft_tokens = counters["num_draft_tokens"]
+    accepted = counters["num_accepted_tokens"]
+    return {
+        "num_drafts": int(drafts),
+        "num_draft_tokens": int(draft_tokens),
+        "num_accepted_tokens": int(accepted),
+        "acceptance_rate": round(accepted / draft_tokens, 4) if draft_tokens else None,
+        # Tokens emitted per verification step: 1 bonus/target token plus accepted drafts.
+        "mean_acceptance_length": round(1 + accepted / drafts, 3) if drafts else None,
+    }
 
 @app.get("/health")
 async def health():
@@ -149,7 +627,43 @@ async def build_info():
     return {
         "build_time": build_time,
         "model": "google/gemma-3-4b-it",
-        "framework": "vLLM"
+        "framework": "vLLM",
+        "gpu_memory_budget": GPU_MEMORY_PLAN,
+    }
+
+@app.get("/speculative")
+async def speculative_stats():
+    """Speculative decoding configuration plus acceptance and throughput metrics per endpoint."""
+    endpoints = {}
+    for endpoint, stats in _generation_stats.items():
+        elapsed = stats["elapsed_seconds"]
+        decode_seconds = stats["decode_seconds"]
+        endpoints[endpoint] = {
+            "requests": stats["requests"],
+            "completion_tokens": stats["completion_tokens"],
+            # End-to-end, including queueing and prefill.
+            "tokens_per_second": round(stats["completion_tokens"] / elapsed, 2) if elapsed > 0 else 0,
+            "mean_time_to_first_token_seconds": (
+                round(stats["ttft_seconds"] / stats["ttft_requests"], 3) if stats["ttft_requests"] else None
+            ),
+            # Compare against a run with speculation disabled to judge the speedup.
+            "decode_tokens_per_second": round(stats["decode_tokens"] / decode_seconds, 2) if decode_seconds > 0 else None,
+            # Vision endpoints only: tokens per decode step (1.0 without prompt lookup).
+            "mean_tokens_per_step": (
+                round(stats["stepped_tokens"] / stats["decode_steps"], 3) if stats["decode_steps"] else None
+            ),
+        }
+
+    return {
+        "vllm": {
+            "speculative_config": VLLM_SPECULATIVE_CONFIG,
+            "engine": _engine_spec_decode_counters(),
+        },
+        # vLLM only reports acceptance engine-wide; per-endpoint acceptance is not available for text endpoints.
+        "vision": {
+            "prompt_lookup_num_tokens": GEMMA_VISION_PROMPT_LOOKUP_TOKENS or None,
+        },
+        "endpoints": endpoints,
     }
 
 @app.get("/", response_class=HTMLResponse)
@@ -161,11 +675,13 @@ async def read_index():
 class Item(BaseModel):
     prompt: str
     stream: bool = False
+    # Optional constrained decoding: a JSON Schema object or a regex (not both).
+    json_schema: Optional[dict] = None
+    regex: Optional[str] = None
 
 
 @app.post("/predict")
 async def predict(item: Item):
-    import time
     start_time = time.time()
     
     prompt = item.prompt
@@ -174,24 +690,28 @@ async def predict(item: Item):
         return {"error": "No prompt provided"}
 
     # Format the prompt for Gemma
-    formatted_prompt = f"<start_of_turn>user\n{prompt}<end_of_turn>\n<start_of_turn>model\n"
+    formatted_prompt = _format_prompt(prompt)
 
     logging.info(f"Received prompt (length: {len(prompt)} chars)")
 
+    structured_output = _parse_structured_output(item.json_schema, item.regex)
+
     # Create sampling parameters
-    sampling_params = SamplingParams(
-        temperature=0.7,
-        top_p=0.9,
-        max_tokens=VLLM_MAX_TOKENS,
-        stop=["<end_of_turn>"]
-    )
+    sampling_params = _sampling_params(structured_output=structured_output)
 
     request_id = random_uuid()
 
     # Run the model (collect the final streamed output)
     output = None
-    async for request_output in llm.generate(formatted_prompt, sampling_params, request_id):
-        output = request_output
+    first_token_time = None
+    try:
+        async for request_output in llm.generate(formatted_prompt, sampling_params, request_id):
+            output = request_output
+            if first_token_time is None and output.outputs and output.outputs[0].token_ids:
+                first_token_time = time.time()
+    except ValueError as e:
+        # vLLM request validation, e.g. a schema or regex its grammar backend rejects.
+        raise HTTPException(status_code=400, detail=str(e))
 
     if output is None or not output.outputs:
         raise HTTPException(status_code=500, detail="No output generated")
@@ -202,8 +722,10 @@ async def predict(item: Item):
     total_tokens = prompt_tokens + completion_tokens
 
     # Add timings to the response
-    elapsed_time = time.time() - start_time
+    end_time = time.time()
+    elapsed_time = end_time - start_time
     tokens_per_second = completion_tokens / elapsed_time if elapsed_time > 0 else 0
+    _record_generation("predict", completion_tokens, start_time, first_token_time, end_time)
     
     logging.info(f"Generated {completion_tokens} tokens in {elapsed_time:.2f}s ({tokens_per_second:.2f} tokens/s)")
     
@@ -231,25 +753,45 @@ async def predictstream(item: Item):
     logging.info(f"Received streaming prompt: {prompt}")
 
     # Format the prompt for Gemma
-    formatted_prompt = f"<start_of_turn>user\n{prompt}<end_of_turn>\n<start_of_turn>model\n"
+    formatted_prompt = _format_prompt(prompt)
+
+    structured_output = _parse_structured_output(item.json_schema, item.regex)
 
     # Create sampling parameters
-    sampling_params = SamplingParams(
-        temperature=0.7,
-        top_p=0.9,
-        max_tokens=VLLM_MAX_TOKENS,
-        stop=["<end_of_turn>"]
-    )
+    sampling_params = _sampling_params(structured_output=structured_output)
 
     request_id = random_uuid()
+    start_time = time.time()
+
+    # Pull the first output before streaming so vLLM request validation errors
+    # (e.g. a rejected schema or regex) become a 400 instead of an in-stream error.
+    outputs = llm.generate(formatted_prompt, sampling_params, request_id)
+    try:
+        first_output = await anext(outputs)
+    except StopAsyncIteration:
+        first_output = None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    first_output_time = time.time()
+
+    async def all_outputs():
+        if first_output is not None:
+            yield first_output
+        async for request_output in outputs:
+            yield request_output
 
     async def token_generator():
         previous_text = ""
+        completion_tokens = 0
+        first_token_time = None
         try:
-            async for request_output in llm.generate(formatted_prompt, sampling_params, request_id):
+            async for request_output in all_outputs():
                 if not request_output.outputs:
                     continue
 
+                completion_tokens = len(request_output.outputs[0].token_ids or [])
+                if first_token_time is None and completion_tokens:
+                    first_token_time = first_output_time if request_output is first_output else time.time()
                 current_text = request_output.outputs[0].text
                 delta = current_text[len(previous_text):]
                 previous_text = current_text
@@ -258,6 +800,8 @@ async def predictstream(item: Item):
                     # Frontend expects repeated JSON objects in the raw stream.
                     yield json.dumps({"response": delta}) + "\n"
 
+            _record_generation("predictstream", completion_tokens, start_time, first_token_time, time.time())
+
         except asyncio.CancelledError:
             logging.info("Streaming cancelled")
             try:
@@ -274,11 +818,165 @@ async def predictstream(item: Item):
     return StreamingResponse(token_generator(), media_type="application/json")
 
 
+class BatchPromptItem(BaseModel):
+    prompt: str
+    # Optional per-item overrides; defaults match /predict.
+    temperature: Optional[float] = None
+    top_p: Optional[float] = None
+    max_tokens: Optional[int] = None
+    json_schema: Optional[dict] = None
+    regex: Optional[str] = None
+
+
+class BatchRequest(BaseModel):
+    items: List[BatchPromptItem]
+    order: Literal["completion", "input"] = "completion"
+
+
+def _batch_sampling_params(item: BatchPromptItem) -> SamplingParams:
+    """Validate one batch item's overrides and build its sampling parameters."""
+    overrides = {}
+    if item.temperature is not None:
+        if item.temperature < 0:
+            raise HTTPException(status_code=400, detail="temperature must be >= 0")
+        overrides["temperature"] = item.temperature
+    if item.top_p is not None:
+        if item.top_p <= 0 or item.top_p > 1:
+            raise HTTPException(status_code=400, detail="top_p must be in (0, 1]")
+        overrides["top_p"] = item.top_p
+    if item.max_tokens is not None:
+        if item.max_tokens < 1 or item.max_tokens > VLLM_MAX_TOKENS:
+            raise HTTPException(status_code=400, detail=f"max_tokens must be between 1 and {VLLM_MAX_TOKENS}")
+        overrides["max_tokens"] = item.max_tokens
+
+    structured_output = _parse_structured_output(item.json_schema, item.regex)
+    return _sampling_params(structured_output=structured_output, **overrides)
+
+
+async def _generate_batch_item(index: int, item: BatchPromptItem) -> dict:
+    """Run one batch prompt through the engine and return its NDJSON result record."""
+    start_time = time.time()
+    request_id = random_uuid()
+    try:
+        if not item.prompt:
+            raise HTTPException(status_code=400, detail="No prompt provided")
+
+        sampling_params = _batch_sampling_params(item)
+
+        output = None
+        first_token_time = None
+        async for request_output in llm.generate(_format_prompt(item.prompt), sampling_params, request_id):
+            output = request_output
+            if first_token_time is None and output.outputs and output.outputs[0].token_ids:
+                first_token_time = time.time()
+
+        if output is None or not output.outputs:
+            raise RuntimeError("No output generated")
+
+        prompt_tokens = len(output.prompt_token_ids or [])
+        completion_tokens = len(output.outputs[0].token_ids or [])
+        end_time = time.time()
+        elapsed_time = end_time - start_time
+        _record_generation("predictbatch", completion_tokens, start_time, first_token_time, end_time)
+
+        return {
+            "type": "result",
+            "index": index,
+            "response": output.outputs[0].text,
+            "finish_reason": output.outputs[0].finish_reason,
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+            "performance": {
+                "elapsed_seconds": round(elapsed_time, 2),
+                # Includes time queued behind other batch items.
+                "time_to_first_token_seconds": (
+                    round(first_token_time - start_time, 3) if first_token_time is not None else None
+                ),
+                "tokens_per_second": round(completion_tokens / elapsed_time, 2) if elapsed_time > 0 else 0,
+            },
+        }
+
+    except asyncio.CancelledError:
+        try:
+            await llm.abort(request_id)
+        except Exception:
+            pass
+        raise
+
+    except HTTPException as he:
+        return {"type": "result", "index": index, "error": str(he.detail)}
+    except ValueError as e:
+        # vLLM request validation (e.g. prompt + max_tokens over max_model_len, rejected schema).
+        return {"type": "result", "index": index, "error": str(e)}
+    except Exception as e:
+        logger.exception("Failed to generate one prompt in batch")
+        return {"type": "result", "index": index, "error": str(e)}
+
+
+@app.post("/predictbatch")
+async def predict_batch(batch: BatchRequest):
+    """Submit many prompts to the engine at once and stream one result per prompt as NDJSON.
+
+    All prompts are scheduled immediately so vLLM can batch them continuously.
+    Results are emitted as they finish (`order="completion"`) or in request
+    order (`order="input"`); each record carries its input `index`.
+    """
+
+    if not batch.items:
+        raise HTTPException(status_code=400, detail="No prompts provided")
+    if len(batch.items) > PREDICT_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {PREDICT_BATCH_MAX_ITEMS} prompts per batch")
+
+    logging.info(f"Received prompt batch ({len(batch.items)} items, order={batch.order})")
+
+    async def event_stream():
+        start_time = time.time()
+        tasks = [asyncio.create_task(_generate_batch_item(idx, item)) for idx, item in enumerate(batch.items)]
+        try:
+            yield json.dumps(
+                {
+                    "type": "meta",
+                    "count": len(tasks),
+                    "order": batch.order,
+                    "model": "google/gemma-3-4b-it",
+                }
+            ) + "\n"
+
+            if batch.order == "input":
+                pending = iter(tasks)
+            else:
+                pending = asyncio.as_completed(tasks)
+
+            for next_result in pending:
+                yield json.dumps(await next_result) + "\n"
+
+            yield json.dumps(
+                {"type": "done", "elapsed_seconds": round(time.time() - start_time, 2)}
+            ) + "\n"
+
+        except asyncio.CancelledError:
+            logging.info("Prompt batch streaming cancelled")
+            raise
+
+        finally:
+            # Client went away or the stream failed: abort whatever is still running.
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    return StreamingResponse(event_stream(), media_type="application/json")
+
+
 @app.post("/describeimage")
 async def describe_image(
     file: UploadFile = File(...),
     prompt: str = Form("Describe this image."),
     max_new_tokens: int = Form(512),
+    json_schema: Optional[str] = Form(None),
+    regex: Optional[str] = Form(None),
 ):
     """Upload an image and ask Gemma 3 (multimodal) to describe it."""
 
@@ -294,12 +992,15 @@ async def describe_image(
         if max_new_tokens < 1 or max_new_tokens > 2048:
             raise HTTPException(status_code=400, detail="max_new_tokens must be between 1 and 2048")
 
+        structured_output = _parse_structured_output(json_schema, regex)
+
         import torch
         from PIL import Image
 
         image = Image.open(BytesIO(contents)).convert("RGB")
 
         processor, model, device = await _get_gemma_vision()
+        compiled_grammar = await asyncio.to_thread(_get_compiled_grammar, processor, model, structured_output)
 
         messages = [
             {
@@ -330,9 +1031,19 @@ async def describe_image(
 
         input_len = inputs["input_ids"].shape[-1]
 
-        with torch.inference_mode():
-            generation = model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False)
-            generation = generation[0][input_len:]
+        timer = _GenerationTimer()
+        generation = await asyncio.to_thread(
+            _vision_generate,
+            model,
+            **inputs,
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            streamer=timer,
+            logits_processor=_structured_logits_processor(compiled_grammar),
+            **_vision_speculative_kwargs(compiled_grammar),
+        )
+        generation = generation[0][input_len:]
+        timer.record("describeimage")
 
         description = processor.decode(generation, skip_special_tokens=True)
         return {
@@ -354,6 +1065,8 @@ async def describe_image_batch(
     files: List[UploadFile] = File(...),
     prompt: str = Form("Describe these images."),
     max_new_tokens: int = Form(512),
+    json_schema: Optional[str] = Form(None),
+    regex: Optional[str] = Form(None),
 ):
     """Upload multiple images and ask Gemma 3 (multimodal) to describe each using the same prompt."""
 
@@ -365,10 +1078,13 @@ async def describe_image_batch(
         if max_new_tokens < 1 or max_new_tokens > 2048:
             raise HTTPException(status_code=400, detail="max_new_tokens must be between 1 and 2048")
 
+        structured_output = _parse_structured_output(json_schema, regex)
+
         import torch
         from PIL import Image
 
         processor, model, device = await _get_gemma_vision()
+        compiled_grammar = await asyncio.to_thread(_get_compiled_grammar, processor, model, structured_output)
 
         results = []
         for upload in files:
@@ -408,9 +1124,19 @@ async def describe_image_batch(
 
                 input_len = inputs["input_ids"].shape[-1]
 
-                with torch.inference_mode():
-                    generation = model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False)
-                    generation = generation[0][input_len:]
+                timer = _GenerationTimer()
+                generation = await asyncio.to_thread(
+                    _vision_generate,
+                    model,
+                    **inputs,
+                    max_new_tokens=max_new_tokens,
+                    do_sample=False,
+                    streamer=timer,
+                    logits_processor=_structured_logits_processor(compiled_grammar),
+                    **_vision_speculative_kwargs(compiled_grammar),
+                )
+                generation = generation[0][input_len:]
+                timer.record("describeimagebatch")
 
                 description = processor.decode(generation, skip_special_tokens=True)
                 results.append(
@@ -444,6 +1170,8 @@ async def describe_image_batch_stream(
     files: List[UploadFile] = File(...),
     prompt: str = Form("Describe these images."),
     max_new_tokens: int = Form(512),
+    json_schema: Optional[str] = Form(None),
+    regex: Optional[str] = Form(None),
 ):
     """Upload multiple images and stream one result per image as NDJSON.
 
@@ -459,10 +1187,13 @@ async def describe_image_batch_stream(
         if max_new_tokens < 1 or max_new_tokens > 2048:
             raise HTTPException(status_code=400, detail="max_new_tokens must be between 1 and 2048")
 
+        structured_output = _parse_structured_output(json_schema, regex)
+
         import torch
         from PIL import Image
 
         processor, model, device = await _get_gemma_vision()
+        compiled_grammar = await asyncio.to_thread(_get_compiled_grammar, processor, model, structured_output)
 
         async def event_stream():
             # Initial metadata
@@ -522,9 +1253,19 @@ async def describe_image_batch_stream(
 
                     input_len = inputs["input_ids"].shape[-1]
 
-                    with torch.inference_mode():
-                        generation = model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False)
-                        generation = generation[0][input_len:]
+                    timer = _GenerationTimer()
+                    generation = await asyncio.to_thread(
+                        _vision_generate,
+                        model,
+                        **inputs,
+                        max_new_tokens=max_new_tokens,
+                        do_sample=False,
+                        streamer=timer,
+                        logits_processor=_structured_logits_processor(compiled_grammar),
+                        **_vision_speculative_kwargs(compiled_grammar),
+                    )
+                    generation = generation[0][input_len:]
+                    timer.record("describeimagebatchstream")
 
                     description = processor.decode(generation, skip_special_tokens=True)
 
@@ -573,6 +1314,8 @@ async def describe_image_stream(
     file: UploadFile = File(...),
     prompt: str = Form("Describe this image."),
     max_new_tokens: int = Form(512),
+    json_schema: Optional[str] = Form(None),
+    regex: Optional[str] = Form(None),
 ):
     """Upload an image and stream Gemma 3 (multimodal) output tokens."""
 
@@ -587,6 +1330,8 @@ async def describe_image_stream(
     if max_new_tokens < 1 or max_new_tokens > 2048:
         raise HTTPException(status_code=400, detail="max_new_tokens must be between 1 and 2048")
 
+    structured_output = _parse_structured_output(json_schema, regex)
+
     try:
         import torch
         from PIL import Image
@@ -594,6 +1339,7 @@ async def describe_image_stream(
 
         image = Image.open(BytesIO(contents)).convert("RGB")
         processor, model, device = await _get_gemma_vision()
+        compiled_grammar = await asyncio.to_thread(_get_compiled_grammar, processor, model, structured_output)
 
         messages = [
             {
@@ -628,26 +1374,28 @@ async def describe_image_stream(
             skip_special_tokens=True,
         )
 
+        timer = _GenerationTimer(streamer)
         generation_error = None
 
         def _run_generation():
             nonlocal generation_error
             try:
-                with torch.inference_mode():
-                    model.generate(
-                        **inputs,
-                        max_new_tokens=max_new_tokens,
-                        do_sample=False,
-                        streamer=streamer,
-                    )
+                _vision_generate(
+                    model,
+                    **inputs,
+                    max_new_tokens=max_new_tokens,
+                    do_sample=False,
+                    streamer=timer,
+                    logits_processor=_structured_logits_processor(compiled_grammar),
+                    **_vision_speculative_kwargs(compiled_grammar),
+                )
             except Exception as e:
                 generation_error = str(e)
                 logger.error(f"Gemma vision generation error: {e}")
             finally:
                 # Ensure the streamer terminates so the HTTP response can close.
                 try:
-                    if hasattr(streamer, "end"):
-                        streamer.end()
+                    timer.end()
                 except Exception:
                     pass
 
@@ -672,6 +1420,8 @@ async def describe_image_stream(
             # If generation failed, emit an error record at the end.
             if generation_error:
                 yield json.dumps({"error": generation_error}) + "\n"
+            else:
+                timer.record("describeimagestream")
 
         return StreamingResponse(token_generator(), media_type="application/json")
 
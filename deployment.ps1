@@ -46,7 +46,7 @@ az containerapp create --name $ContainerAppName `
     --cpu 8 --memory 16Gi --environment me-gpullm `
     --registry-server $acrLoginServer `
     --ingress 'external' --target-port 5000 --workload-profile-name NC24-A100 `
-    --env-vars NVIDIA_DRIVER_CAPABILITIES=compute,utility VLLM_GPU_MEMORY_UTILIZATION=0.70 VLLM_ENFORCE_EAGER=true `
+    --env-vars NVIDIA_DRIVER_CAPABILITIES=compute,utility VLLM_ENFORCE_EAGER=true `
     --min-replicas 2 --max-replicas 2 `
     --scale-rule-name http-concurrency --scale-rule-http-concurrency 2 `
     --system-assigned
@@ -0,0 +1,86 @@
+"""GPU memory arithmetic for the startup planner in app.py.
+
+Pure functions over a Hugging Face text config, kept free of torch/vLLM imports
+so they can be unit tested without a GPU.
+"""
+
+
+def _cdiv(a: int, b: int) -> int:
+    return -(-a // b)
+
+
+def layer_types(text_config) -> list:
+    """Attention type per decoder layer ("full_attention" / "sliding_attention")."""
+    types = getattr(text_config, "layer_types", None)
+    if types:
+        return list(types)
+    # Older configs: every `sliding_window_pattern`-th layer is global attention.
+    pattern = getattr(text_config, "sliding_window_pattern", None)
+    return [
+        "full_attention" if not pattern or (i + 1) % pattern == 0 else "sliding_attention"
+        for i in range(text_config.num_hidden_layers)
+    ]
+
+
+def kv_cache_bytes(text_config, seq_len: int) -> int:
+    """Estimated bf16 KV cache bytes for one `seq_len`-token sequence.
+
+    Sliding-window layers (most of Gemma 3) only hold the last `sliding_window` tokens.
+    """
+    head_dim = getattr(text_config, "head_dim", None) or text_config.hidden_size // text_config.num_attention_heads
+    num_kv_heads = getattr(text_config, "num_key_value_heads", None) or text_config.num_attention_heads
+    window = getattr(text_config, "sliding_window", None) or seq_len
+
+    cached_tokens = sum(
+        min(seq_len, window) if t == "sliding_attention" else seq_len for t in layer_types(text_config)
+    )
+    # K and V, 2 bytes each.
+    return cached_tokens * 2 * num_kv_heads * head_dim * 2
+
+
+def fit_max_model_len(kv_budget_bytes: int, text_config, max_model_len: int, min_model_len: int) -> int:
+    """Largest context (<= max_model_len, in 256-token steps) whose KV cache fits the budget.
+
+    The floor is min(min_model_len, max_model_len), so a deliberately small
+    max_model_len is never refused for being below the minimum. Raises
+    RuntimeError when not even the floor fits.
+    """
+    floor = min(min_model_len, max_model_len)
+    fitted = max_model_len
+    while fitted > floor and kv_budget_bytes < kv_cache_bytes(text_config, fitted):
+        fitted = max((fitted - 1) // 256 * 256, floor)
+    if kv_budget_bytes < kv_cache_bytes(text_config, fitted):
+        raise RuntimeError(
+            f"GPU memory plan overcommitted: ~{kv_budget_bytes / 2**20:.0f} MiB left for KV cache, need "
+            f"{kv_cache_bytes(text_config, fitted) / 2**20:.0f} MiB for one {fitted}-token sequence"
+        )
+    return fitted
+
+
+def blocks_per_sequence(text_config, max_model_len: int, block_size: int, max_num_batched_tokens: int) -> int:
+    """KV blocks one max_model_len sequence needs under vLLM V1's hybrid allocator.
+
+    Mirrors vLLM's grouping: layers of each attention type are split into
+    groups of equal size (the smallest per-type layer count, or the largest one
+    when the counts are within 25%), every group gets its own block table, and
+    one block spans one layer of each group member. Sliding-window groups only
+    keep `sliding_window - 1 + max_num_batched_tokens` tokens (+1 block).
+    """
+    counts = {}
+    for t in layer_types(text_config):
+        counts[t] = counts.get(t, 0) + 1
+
+    group_size = min(counts.values())
+    if max(counts.values()) < group_size * 1.25:
+        group_size = max(counts.values())
+
+    window = getattr(text_config, "sliding_window", None)
+    blocks = 0
+    for attention_type, count in counts.items():
+        if attention_type == "sliding_attention" and window:
+            num_tokens = min(window - 1 + max_num_batched_tokens, max_model_len)
+            group_blocks = _cdiv(num_tokens, block_size) + 1
+        else:
+            group_blocks = _cdiv(max_model_len, block_size)
+        blocks += _cdiv(count, group_size) * group_blocks
+    return blocks
@@ -0,0 +1,65 @@
+from types import SimpleNamespace
+
+import pytest
+
+from gpu_memory import blocks_per_sequence, fit_max_model_len, kv_cache_bytes
+
+# Shape of gemma-3-4b-it's text config: 34 layers, every 6th global, 1024-token window.
+GEMMA3_4B = SimpleNamespace(
+    num_hidden_layers=34,
+    num_attention_heads=8,
+    num_key_value_heads=4,
+    head_dim=256,
+    hidden_size=2560,
+    sliding_window=1024,
+    sliding_window_pattern=6,
+)
+PER_TOKEN_LAYER = 2 * 4 * 256 * 2
+MIB = 2**20
+
+
+def test_kv_cache_bytes_counts_sliding_layers_up_to_window():
+    # 5 full-attention layers hold all 4096 tokens, 29 sliding layers hold 1024.
+    assert kv_cache_bytes(GEMMA3_4B, 4096) == (5 * 4096 + 29 * 1024) * PER_TOKEN_LAYER
+    assert kv_cache_bytes(GEMMA3_4B, 512) == 34 * 512 * PER_TOKEN_LAYER
+
+
+def test_kv_cache_bytes_prefers_explicit_layer_types():
+    config = SimpleNamespace(**vars(GEMMA3_4B), layer_types=["full_attention"] * 34)
+    assert kv_cache_bytes(config, 4096) == 34 * 4096 * PER_TOKEN_LAYER
+
+
+def test_fit_keeps_max_model_len_when_it_fits():
+    assert fit_max_model_len(2**40, GEMMA3_4B, 4096, 1024) == 4096
+
+
+def test_fit_does_not_refuse_small_max_model_len():
+    assert fit_max_model_len(2**40, GEMMA3_4B, 512, 1024) == 512
+
+
+def test_fit_shrinks_to_largest_fitting_256_multiple():
+    budget = kv_cache_bytes(GEMMA3_4B, 2600)
+    assert fit_max_model_len(budget, GEMMA3_4B, 4096, 1024) == 2560
+
+
+def test_fit_refuses_when_floor_does_not_fit():
+    budget = kv_cache_bytes(GEMMA3_4B, 1024) - 1
+    with pytest.raises(RuntimeError, match="overcommitted"):
+        fit_max_model_len(budget, GEMMA3_4B, 4096, 1024)
+
+
+def test_fit_refuses_negative_budget():
+    with pytest.raises(RuntimeError):
+        fit_max_model_len(-100 * MIB, GEMMA3_4B, 512, 1024)
+
+
+def test_blocks_per_sequence_matches_vllm_hybrid_grouping():
+    # Group size 5 (full-attention count): 1 full group, ceil(29 / 5) = 6 sliding groups.
+    full_blocks = 4096 // 16
+    sliding_blocks = -(-min(1024 - 1 + 2048, 4096) // 16) + 1
+    assert blocks_per_sequence(GEMMA3_4B, 4096, 16, 2048) == full_blocks + 6 * sliding_blocks
+
+
+def test_blocks_per_sequence_full_attention_only():
+    config = SimpleNamespace(**vars(GEMMA3_4B), layer_types=["full_attention"] * 34)
+    assert blocks_per_sequence(config, 4096, 16, 2048) == 4096 // 16